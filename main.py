@@ -1,13 +1,136 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 import chess
 import chess.pgn
 import chess.engine
-import io
-from typing import Optional, List, Dict, Any
+import chess.polyglot
+import hashlib
+import heapq
+import logging
+import orjson
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import Optional, List, Dict, Any, Tuple, Callable, Iterator, NamedTuple, Set, Union
+
+LOGGER = logging.getLogger(__name__)
 
 app = FastAPI(title="Stockfish PGN Analyzer", version="1.0.0")
 
+STOCKFISH_PATH = os.environ.get("STOCKFISH_PATH", "/usr/games/stockfish")
+# Number of pre-warmed engines; each analysis task checks one out while it runs.
+# Defaults to the CPUs this process may run on (cgroup/taskset aware on Linux).
+ENGINE_POOL_SIZE = int(os.environ.get(
+    "ENGINE_POOL_SIZE",
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1,
+))
+# Per engine, so total hash is ENGINE_POOL_SIZE x this (per uvicorn worker).
+# 64 MB comfortably holds one game's worth of plies at Threads=1.
+ENGINE_HASH_MB = int(os.environ.get("ENGINE_HASH_MB", "64"))
+# Pin each pooled engine to its own core (Linux only) so the scheduler does not
+# migrate it and throw away its warm caches.
+ENGINE_PIN_CPUS = os.environ.get("ENGINE_PIN_CPUS", "1") not in ("0", "false", "no")
+# How long an analysis task waits for a free engine before failing the request.
+ENGINE_CHECKOUT_TIMEOUT_SEC = float(os.environ.get("ENGINE_CHECKOUT_TIMEOUT_SEC", "300"))
+# Spawn attempts when replacing an engine that died mid-request.
+ENGINE_RESPAWN_ATTEMPTS = 3
+
+POOL: "queue.Queue[chess.engine.SimpleEngine]" = queue.Queue()
+# CPU each engine is pinned to, so a respawned engine lands on the same core.
+_engine_cpus: Dict[chess.engine.SimpleEngine, Optional[int]] = {}
+# Bounded LRU of per-position results shared across requests. Keyed by
+# (zobrist, (depth, time_sec, nodes, multipv, with_san, with_pvs)); values
+# are (eval_cp_main, pvs).
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", "200000"))
+_analysis_cache: "OrderedDict[Tuple[Any, ...], Tuple[Optional[int], List[Dict[str, Any]]]]" = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
+# Whole-response cache for /analyze_pgn:
+# blake2b(request) -> (expiry, body, ETag derived from the body).
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL_SEC = float(os.environ.get("RESULT_CACHE_TTL_SEC", str(24 * 3600)))
+_result_cache: "OrderedDict[str, Tuple[float, bytes, str]]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+# Games are not split into chunks shorter than this: each chunk pays a hash
+# table clear and a cold start on its engine.
+MIN_CHUNK_PLIES = int(os.environ.get("MIN_CHUNK_PLIES", "16"))
+
+# Ply chunks from all requests are fanned out here; each task holds one engine.
+EXECUTOR = ThreadPoolExecutor(max_workers=max(1, ENGINE_POOL_SIZE))
+
+def _open_engine(cpu: Optional[int] = None) -> chess.engine.SimpleEngine:
+    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+    try:
+        if cpu is not None:
+            try:
+                os.sched_setaffinity(engine.transport.get_pid(), {cpu})
+            except (AttributeError, OSError):
+                pass
+
+        # Fixed options are set once here; MultiPV is passed per analyse() call and
+        # python-chess only re-sends setoption when the value actually changes.
+        engine.configure({"Threads": 1, "Hash": ENGINE_HASH_MB})
+
+        # Warm-up search: forces the NNUE load and hash allocation now rather than
+        # on the first real request.
+        engine.analyse(chess.Board(), chess.engine.Limit(depth=1))
+    except Exception:
+        engine.close()
+        raise
+
+    _engine_cpus[engine] = cpu
+    return engine
+
+@app.on_event("startup")
+def start_engine_pool() -> None:
+    cpus: List[Optional[int]] = [None]
+    if ENGINE_PIN_CPUS and hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0)) or [None]
+    for i in range(max(1, ENGINE_POOL_SIZE)):
+        POOL.put(_open_engine(cpus[i % len(cpus)]))
+
+def _checkout_engine() -> chess.engine.SimpleEngine:
+    # Bounded wait so a starved pool fails the request instead of hanging it.
+    try:
+        return POOL.get(timeout=ENGINE_CHECKOUT_TIMEOUT_SEC)
+    except queue.Empty:
+        raise RuntimeError("No Stockfish engine became available within {}s.".format(ENGINE_CHECKOUT_TIMEOUT_SEC))
+
+def _release_engine(engine: chess.engine.SimpleEngine) -> None:
+    # Return the engine to the pool; replace it if the process died mid-request.
+    if engine.protocol.returncode.done():
+        cpu = _engine_cpus.pop(engine, None)
+        for attempt in range(1, ENGINE_RESPAWN_ATTEMPTS + 1):
+            try:
+                engine = _open_engine(cpu)
+                break
+            except Exception:
+                LOGGER.exception("Failed to respawn Stockfish (attempt %d/%d)", attempt, ENGINE_RESPAWN_ATTEMPTS)
+        else:
+            LOGGER.error("Engine pool shrank by one; %d engine(s) idle", POOL.qsize())
+            return
+    POOL.put(engine)
+
+@app.on_event("shutdown")
+def stop_engine_pool() -> None:
+    while True:
+        try:
+            engine = POOL.get_nowait()
+        except queue.Empty:
+            break
+        _engine_cpus.pop(engine, None)
+        try:
+            engine.quit()
+        except Exception:
+            pass
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 class AnalyzeRequest(BaseModel):
     pgn: str
     initial_fen: Optional[str] = None
@@ -15,24 +138,273 @@ class AnalyzeRequest(BaseModel):
     multipv: int = 2
     # Time per ply (seconds). If you prefer depth-only, keep this low.
     time_sec: float = 0.05
+    # Fixed node budget per ply. When set it replaces depth/time_sec: every
+    # ply costs about the same and results no longer depend on machine load.
+    nodes: Optional[int] = None
+    # fen_after costs a full-board scan per ply; clients that replay the moves
+    # themselves can turn it off.
+    include_fen: bool = True
+    # SAN needs a disambiguation scan and a check test per move. When off, only
+    # key moments get played_san; everything else ships UCI only.
+    include_san: bool = True
+    # Without PVs the engine searches a single line (MultiPV=1) and only the
+    # main eval is returned; `multipv` is then ignored.
+    include_pvs: bool = True
+    # Two-pass mode: when set, every ply is first scored at this depth (single
+    # line, no PVs) and only the key-moment candidates are re-searched at
+    # `depth`/`multipv`. Other plies keep the shallow eval and empty pvs, and
+    # key moments are only picked among the re-searched plies. If `nodes` is
+    # set, the scan uses a node budget instead (`scan_nodes`, default
+    # nodes // 10) so results stay reproducible.
+    scan_depth: Optional[int] = None
+    scan_time_sec: float = 0.02
+    scan_nodes: Optional[int] = None
+    # Compact key moments: {"ply_index", "swing"} entries pointing into
+    # per_ply (0-based) instead of repeating ply/played_san/eval_cp.
+    key_moments_by_index: bool = False
+
+class BatchRequest(BaseModel):
+    games: List[AnalyzeRequest]
 
 class MovePV(BaseModel):
     rank: int
     uci: str
-    san: str
+    san: Optional[str] = None
+    eval_cp: Optional[int] = None
+
+class PerPly(BaseModel):
+    ply: int
+    played_uci: str
+    played_san: Optional[str] = None
+    fen_after: Optional[str] = None
+    eval_cp: Optional[int] = None
+    pvs: List[MovePV] = []
+
+class KeyMoment(BaseModel):
+    ply: int
+    played_san: Optional[str] = None
     eval_cp: Optional[int] = None
+    swing: int
+
+class KeyMomentRef(BaseModel):
+    ply_index: int
+    swing: int
+
+class ErrorInfo(BaseModel):
+    code: str
+    message: str
+    details: Dict[str, Any] = {}
+
+class AnalyzeResponse(BaseModel):
+    status: str
+    legal: bool
+    per_ply: List[PerPly] = []
+    key_moments: List[Union[KeyMoment, KeyMomentRef]] = []
+    error: Optional[ErrorInfo] = None
 
 def _score_to_cp(score: chess.engine.PovScore) -> Optional[int]:
     # centipawns from the side-to-move perspective; mate scores become large cp
     s = score.pov(chess.WHITE)
     if s.is_mate():
         # represent mate as a big number with sign
-        m = s.mate()
-        if m is None:
-            return None
-        return 100000 if m > 0 else -100000
+        # (compare rather than read mate(): Mate(0) has no sign of its own)
+        return 100000 if s > chess.engine.Cp(0) else -100000
     return s.score()
 
+def _cache_get(key: Tuple[Any, ...]) -> Optional[Tuple[Optional[int], List[Dict[str, Any]]]]:
+    with _analysis_cache_lock:
+        hit = _analysis_cache.get(key)
+        if hit is not None:
+            _analysis_cache.move_to_end(key)
+        return hit
+
+def _cache_put(key: Tuple[Any, ...], value: Tuple[Optional[int], List[Dict[str, Any]]]) -> None:
+    if ANALYSIS_CACHE_SIZE <= 0:
+        return
+    with _analysis_cache_lock:
+        _analysis_cache[key] = value
+        _analysis_cache.move_to_end(key)
+        while len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
+
+def _summarize_analysis(
+    board: chess.Board,
+    analysis: List[chess.engine.InfoDict],
+    with_san: bool,
+    with_pvs: bool,
+) -> Tuple[Optional[int], List[Dict[str, Any]]]:
+    if not with_pvs:
+        # Score only: no PV rendering at all. Like the PV path, a line without
+        # a PV (e.g. the game is already over) yields no eval.
+        main = analysis[0]
+        if not main.get("pv") or main.get("score") is None:
+            return (None, [])
+        return (_score_to_cp(main["score"]), [])
+
+    pvs: List[Dict[str, Any]] = []
+    eval_cp_main = None
+
+    for item in analysis:
+        pv = item.get("pv", [])
+        if not pv:
+            continue
+
+        best_move = pv[0]
+        best_uci = best_move.uci()
+        best_san = board.san(best_move) if with_san else None
+        eval_cp = _score_to_cp(item["score"])
+
+        rank = int(item.get("multipv", 1))
+        pvs.append({
+            "rank": rank,
+            "uci": best_uci,
+            "san": best_san,
+            "eval_cp": eval_cp
+        })
+
+        if rank == 1:
+            eval_cp_main = eval_cp
+
+    return (eval_cp_main, sorted(pvs, key=lambda x: x["rank"]))
+
+def _analyse_chunk(
+    start: chess.Board,
+    moves: List[chess.Move],
+    limit: chess.engine.Limit,
+    multipv: int,
+    with_san: bool = True,
+    with_pvs: bool = True,
+    on_result: Optional[Callable[[int, Tuple[Optional[int], List[Dict[str, Any]]]], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    game_id: Optional[object] = None,
+) -> List[Tuple[Optional[int], List[Dict[str, Any]]]]:
+    # Replays `moves` from `start` on one pooled engine, analysing after each
+    # push. Returns (eval_cp_main, pvs) per ply, in order, and also hands each
+    # one to `on_result(index, result)` as soon as it is ready. The engine is
+    # only checked out on the first cache miss; setting `cancel` stops early.
+    engine = None
+    try:
+        # python-chess sends `ucinewgame` (which clears the hash table) only
+        # when the game identity changes. Callers pass one id per request, so
+        # an engine serving several chunks of the same game keeps its table.
+        if game_id is None:
+            game_id = object()
+        # Chunk starts carry no history; the engine gets `position fen ...
+        # moves ...` relative to this board as plies are pushed.
+        board = start.copy(stack=False)
+        out: List[Tuple[Optional[int], List[Dict[str, Any]]]] = []
+
+        # Hot loop: bind lookups once; only the zobrist part of the key varies
+        push = board.push
+        zobrist_hash = chess.polyglot.zobrist_hash
+        cache_get = _cache_get
+        append = out.append
+        settings = (limit.depth, limit.time, limit.nodes, multipv, with_san, with_pvs)
+
+        for i, move in enumerate(moves):
+            if cancel is not None and cancel.is_set():
+                break
+
+            push(move)
+
+            key = (zobrist_hash(board), settings)
+            result = cache_get(key)
+            if result is None:
+                if engine is None:
+                    engine = _checkout_engine()
+
+                # Analyse after the move (position for side to move). Passing the
+                # board itself sends `position ... moves ...` rather than a bare FEN.
+                analysis = engine.analyse(board, limit, multipv=multipv, game=game_id)
+                result = _summarize_analysis(board, analysis, with_san, with_pvs)
+                _cache_put(key, result)
+
+            append(result)
+            if on_result is not None:
+                on_result(i, result)
+
+        return out
+    finally:
+        if engine is not None:
+            _release_engine(engine)
+
+def _boards_before(start: chess.Board, moves: List[chess.Move], plies: List[int]) -> Dict[int, chess.Board]:
+    # Replays up to the last wanted ply, snapshotting the position before each
+    # of the (1-based) plies asked for.
+    wanted = set(plies)
+    board = start.copy(stack=False)
+    out: Dict[int, chess.Board] = {}
+    for ply, move in enumerate(moves[:max(plies, default=0)], start=1):
+        if ply in wanted:
+            out[ply] = board.copy(stack=False)
+        board.push(move)
+    return out
+
+def _san_at_plies(start: chess.Board, moves: List[chess.Move], plies: List[int]) -> Dict[int, str]:
+    return {ply: b.san(moves[ply - 1]) for ply, b in _boards_before(start, moves, plies).items()}
+
+def _top_swings(
+    eval_cp: List[Optional[int]],
+    k: int = 5,
+    only: Optional[Set[int]] = None,
+) -> List[Tuple[int, int]]:
+    # Key moments: largest eval swings (simple heuristic)
+    # (You may already have a smarter key-moment selector elsewhere.)
+    # Returns (swing, ply index) pairs, largest first. With `only`, a swing
+    # counts only if both of its plies are in that index set.
+    swings: List[Tuple[int, int]] = []
+    prev = None
+    prev_i = -1
+    for i, cur in enumerate(eval_cp):
+        if prev is not None and cur is not None:
+            if only is None or (i in only and prev_i in only):
+                swings.append((abs(cur - prev), i))
+        prev = cur
+        prev_i = i
+
+    # O(n log k) top-k over plain tuples; no per-ply dicts
+    return heapq.nlargest(k, swings, key=itemgetter(0))
+
+class _LineReader:
+    # Minimal readline() view over the request string for chess.pgn.read_game,
+    # which only ever calls readline(). io.StringIO would copy the whole PGN
+    # into its own buffer first; this hands out slices of the original.
+    def __init__(self, text: str) -> None:
+        self._text = text
+        self._pos = 0
+
+    def readline(self) -> str:
+        start = self._pos
+        end = self._text.find("\n", start)
+        end = len(self._text) if end < 0 else end + 1
+        self._pos = end
+        return self._text[start:end]
+
+class _MainlineVisitor(chess.pgn.BaseVisitor[Tuple[Optional[chess.Board], List[chess.Move], List[Exception]]]):
+    # Collects the start board and mainline moves into a flat list. Variations
+    # are skipped by the reader, so no GameNode tree is ever built.
+    def begin_game(self) -> None:
+        self.start: Optional[chess.Board] = None
+        self.moves: List[chess.Move] = []
+        self.errors: List[Exception] = []
+
+    def visit_board(self, board: chess.Board) -> None:
+        if self.start is None:
+            self.start = board.copy(stack=False)
+
+    def visit_move(self, board: chess.Board, move: chess.Move) -> None:
+        self.moves.append(move)
+
+    def begin_variation(self) -> chess.pgn.SkipType:
+        return chess.pgn.SKIP
+
+    def handle_error(self, error: Exception) -> None:
+        # Same leniency as GameBuilder: the mainline stops at the bad token.
+        self.errors.append(error)
+
+    def result(self) -> Tuple[Optional[chess.Board], List[chess.Move], List[Exception]]:
+        return (self.start, self.moves, self.errors)
+
 def ok(*, legal: bool = True, per_ply=None, key_moments=None, status: str = "ok", error=None) -> Dict[str, Any]:
     return {
         "status": status,                 # "ok" | "partial" | "error"
@@ -55,130 +427,389 @@ def fail(code: str, message: str, details=None, *, legal: bool = False, per_ply=
         }
     )
     
-@app.post("/analyze_pgn")
-def analyze_pgn(req: AnalyzeRequest) -> Dict[str, Any]:
-    # Parse PGN safely
+class _AnalysisFailed(Exception):
+    # Carries a ready-made fail(...) envelope out of the shared helpers.
+    def __init__(self, envelope: Dict[str, Any]) -> None:
+        super().__init__(envelope["error"]["message"])
+        self.envelope = envelope
+
+class _Mainline(NamedTuple):
+    # Per-ply data is kept column-wise (index i is ply i + 1) and only turned
+    # into row dicts when a response is serialized.
+    root: chess.Board
+    moves: List[chess.Move]
+    played_uci: List[str]
+    played_san: List[Optional[str]]
+    fen_after: List[Optional[str]]
+    eval_cp: List[Optional[int]]
+    pvs: List[List[Dict[str, Any]]]
+    chunk_starts: List[chess.Board]
+    chunks: List[List[chess.Move]]
+
+def _row(walk: _Mainline, i: int) -> Dict[str, Any]:
+    return {
+        "ply": i + 1,
+        "played_uci": walk.played_uci[i],
+        "played_san": walk.played_san[i],
+        "fen_after": walk.fen_after[i],
+        "eval_cp": walk.eval_cp[i],
+        "pvs": walk.pvs[i],
+    }
+
+def _rows(walk: _Mainline) -> List[Dict[str, Any]]:
+    return [_row(walk, i) for i in range(len(walk.moves))]
+
+def _walk_mainline(req: AnalyzeRequest, max_chunks: Optional[int] = None) -> _Mainline:
+    # Parse PGN safely (flat mainline only, no game tree)
     try:
-        game = chess.pgn.read_game(io.StringIO(req.pgn))
+        game = chess.pgn.read_game(_LineReader(req.pgn), Visitor=_MainlineVisitor)
     except Exception as e:
-        return fail("INVALID_PGN", "Could not parse PGN.", details={"exception": str(e)})
+        raise _AnalysisFailed(fail("INVALID_PGN", "Could not parse PGN.", details={"exception": str(e)}))
 
     if game is None:
-        return fail("INVALID_PGN", "Could not parse PGN.")
+        raise _AnalysisFailed(fail("INVALID_PGN", "Could not parse PGN."))
+
+    start, moves, errors = game
 
     # Start board
     try:
         if req.initial_fen:
             board = chess.Board(req.initial_fen)
+        elif start is not None:
+            board = start
         else:
-            board = game.board()
+            # The reader could not build the header position; report its error
+            raise errors[-1] if errors else ValueError("PGN FEN header is invalid.")
     except Exception as e:
-        return fail("INVALID_FEN", "Initial FEN is invalid.", details={"exception": str(e)})
+        raise _AnalysisFailed(fail("INVALID_FEN", "Initial FEN is invalid.", details={"exception": str(e)}))
 
-    engine = None
-    try:
-        # Launch Stockfish
-        engine = chess.engine.SimpleEngine.popen_uci("/usr/games/stockfish")
+    # Walk the mainline once (no engine): legality, SAN and FENs per ply
+    include_fen = req.include_fen
+    include_san = req.include_san
+    root = board.copy(stack=False)
+    played_uci: List[str] = []
+    played_san: List[Optional[str]] = []
+    fen_after: List[Optional[str]] = []
+    chunk_starts: List[chess.Board] = []
+    chunks: List[List[chess.Move]] = []
 
-        # configure multipv if supported
-        try:
-            engine.configure({"MultiPV": max(1, min(req.multipv, 3))})
-        except Exception:
-            pass
+    workers = max(1, min(max_chunks or ENGINE_POOL_SIZE, len(moves) // max(1, MIN_CHUNK_PLIES)))
+    chunk_len = -(-len(moves) // workers) if moves else 1
+
+    # Without an initial_fen override we replay from the reader's own start
+    # position, and the reader only hands over moves parse_san accepted there,
+    # so only null moves ("--", falsy) still need the legality check.
+    trusted = not req.initial_fen
+
+    # Hot loop: bind lookups once
+    is_legal = board.is_legal
+    push = board.push
+    san_of = board.san
+    fen = board.fen
+    append_uci = played_uci.append
+    append_san = played_san.append
+    append_fen = fen_after.append
 
-        per_ply: List[Dict[str, Any]] = []
-        ply = 0
-
-        for move in game.mainline_moves():
-            ply += 1
-
-            # Legality check BEFORE pushing
-            if move not in board.legal_moves:
-                return fail(
-                    "ILLEGAL_MOVE",
-                    "Move is not legal from reconstructed position.",
-                    details={
-                        "first_illegal_move": {
-                            "ply": ply,
-                            "uci": move.uci(),
-                            "fen_before": board.fen(),
-                        }
-                    },
-                )
-
-            san = board.san(move)
-            board.push(move)
-
-            # Analyse after the move (position for side to move)
-            limit = chess.engine.Limit(depth=req.depth, time=req.time_sec)
-            analysis = engine.analyse(
-                board,
-                limit,
-                multipv=max(1, min(req.multipv, 3)),
+    for i, move in enumerate(moves):
+        ply = i + 1
+
+        # Legality check BEFORE pushing
+        if not (trusted and move) and not is_legal(move):
+            raise _AnalysisFailed(fail(
+                "ILLEGAL_MOVE",
+                "Move is not legal from reconstructed position.",
+                details={
+                    "first_illegal_move": {
+                        "ply": ply,
+                        "uci": move.uci(),
+                        "fen_before": board.fen(),
+                    }
+                },
+            ))
+
+        if i % chunk_len == 0:
+            chunk_starts.append(board.copy(stack=False))
+            chunks.append([])
+        chunks[-1].append(move)
+
+        append_san(san_of(move) if include_san else None)
+        push(move)
+
+        append_uci(move.uci())
+        append_fen(fen() if include_fen else None)
+
+    n = len(moves)
+    return _Mainline(
+        root, moves, played_uci, played_san, fen_after,
+        [None] * n, [[] for _ in range(n)],
+        chunk_starts, chunks,
+    )
+
+def _run_analysis(
+    req: AnalyzeRequest,
+    walk: _Mainline,
+    on_ply: Optional[Callable[[Dict[str, Any]], None]] = None,
+    cancel: Optional[threading.Event] = None,
+) -> List[Dict[str, Any]]:
+    # Fills the eval_cp/pvs columns of `walk` (calling `on_ply(row)` after
+    # each update) and returns the key moments.
+    moves = walk.moves
+    eval_cp = walk.eval_cp
+    # One game identity for every chunk and pass of this request
+    game_id = object()
+    # Shared by every chunk, so a failing chunk stops its siblings and their
+    # engines go back to the pool instead of finishing unwanted work.
+    if cancel is None:
+        cancel = threading.Event()
+    pvs = walk.pvs
+
+    def run_chunks(
+        starts: List[chess.Board],
+        chunks: List[List[chess.Move]],
+        first_plies: List[int],
+        limit: chess.engine.Limit,
+        multipv: int,
+        with_san: bool,
+        with_pvs: bool,
+    ) -> None:
+        def on_result(first: int) -> Callable[[int, Tuple[Optional[int], List[Dict[str, Any]]]], None]:
+            def store(i: int, result: Tuple[Optional[int], List[Dict[str, Any]]]) -> None:
+                idx = first - 1 + i
+                eval_cp[idx], pvs[idx] = result
+                if on_ply is not None:
+                    on_ply(_row(walk, idx))
+            return store
+
+        futures = [
+            EXECUTOR.submit(
+                _analyse_chunk, start, chunk, limit, multipv, with_san, with_pvs,
+                on_result(first), cancel, game_id,
             )
+            for start, chunk, first in zip(starts, chunks, first_plies)
+        ]
+        try:
+            for f in futures:
+                f.result()
+        except BaseException:
+            cancel.set()
+            raise
+
+    # Analyse contiguous chunks of plies concurrently, one engine each
+    if req.nodes is not None:
+        limit = chess.engine.Limit(nodes=req.nodes)
+    else:
+        limit = chess.engine.Limit(depth=req.depth, time=req.time_sec)
+    multipv = max(1, min(req.multipv, 3)) if req.include_pvs else 1
+    first_plies: List[int] = []
+    n = 1
+    for chunk in walk.chunks:
+        first_plies.append(n)
+        n += len(chunk)
+
+    deep: Optional[Set[int]] = None
+    if req.scan_depth is not None:
+        # Pass 1: cheap single-line score for every ply
+        if req.nodes is not None:
+            scan_limit = chess.engine.Limit(nodes=req.scan_nodes or max(1, req.nodes // 10))
+        else:
+            scan_limit = chess.engine.Limit(depth=req.scan_depth, time=req.scan_time_sec)
+        run_chunks(walk.chunk_starts, walk.chunks, first_plies, scan_limit, 1, False, False)
+
+        # Candidates must be swings that can survive pass 2. Only the last ply
+        # can end the game, and a finished position has no eval at any depth,
+        # so it never takes a slot.
+        live = set(range(len(moves)))
+        if moves:
+            final = walk.chunk_starts[-1].copy(stack=False)
+            for move in walk.chunks[-1]:
+                final.push(move)
+            if final.is_game_over():
+                live.discard(len(moves) - 1)
+
+        # Pass 2: full search on the swing candidates and the ply before
+        # each. Only swings between two re-searched plies are eligible as
+        # key moments, so a shallow/deep mismatch never ranks as a swing.
+        plies = sorted({p for _, i in _top_swings(eval_cp, only=live) for p in (i, i + 1)})
+        runs: List[List[int]] = []
+        for p in plies:
+            if runs and runs[-1][-1] == p - 1:
+                runs[-1].append(p)
+            else:
+                runs.append([p])
+
+        starts = _boards_before(walk.root, moves, [run[0] for run in runs])
+        run_chunks(
+            [starts[run[0]] for run in runs],
+            [moves[run[0] - 1:run[-1]] for run in runs],
+            [run[0] for run in runs],
+            limit, multipv, req.include_san, req.include_pvs,
+        )
+        deep = {p - 1 for p in plies}
+    else:
+        run_chunks(walk.chunk_starts, walk.chunks, first_plies, limit, multipv, req.include_san, req.include_pvs)
 
-            lines = analysis if isinstance(analysis, list) else [analysis]
-
-            pvs: List[Dict[str, Any]] = []
-            eval_cp_main = None
-
-            for item in lines:
-                pv = item.get("pv", [])
-                if not pv:
-                    continue
-
-                best_move = pv[0]
-                best_uci = best_move.uci()
-                best_san = board.san(best_move)
-                eval_cp = _score_to_cp(item["score"])
-
-                rank = int(item.get("multipv", 1))
-                pvs.append({
-                    "rank": rank,
-                    "uci": best_uci,
-                    "san": best_san,
-                    "eval_cp": eval_cp
-                })
-
-                if rank == 1:
-                    eval_cp_main = eval_cp
-
-            per_ply.append({
-                "ply": ply,
-                "played_uci": move.uci(),
-                "played_san": san,
-                "fen_after": board.fen(),
-                "eval_cp": eval_cp_main,
-                "pvs": sorted(pvs, key=lambda x: x["rank"]),
-            })
-
-        # Key moments: largest eval swings (simple heuristic)
-        # (You may already have a smarter key-moment selector elsewhere.)
-        key_moments: List[Dict[str, Any]] = []
-        prev = None
-        for row in per_ply:
-            cur = row.get("eval_cp")
-            if prev is not None and cur is not None:
-                swing = abs(cur - prev)
-                key_moments.append({
-                    "ply": row["ply"],
-                    "played_san": row["played_san"],
-                    "eval_cp": cur,
-                    "swing": swing
-                })
-            prev = cur
-
-        key_sorted = sorted(key_moments, key=lambda x: x.get("swing", 0), reverse=True)[:5]
-
-        return ok(legal=True, per_ply=per_ply, key_moments=key_sorted)
+    top = _top_swings(eval_cp, only=deep)
+    if req.key_moments_by_index:
+        return [{"ply_index": i, "swing": swing} for swing, i in top]
+
+    if req.include_san:
+        sans = {i + 1: walk.played_san[i] for _, i in top}
+    else:
+        sans = _san_at_plies(walk.root, moves, [i + 1 for _, i in top])
+
+    return [
+        {
+            "ply": i + 1,
+            "played_san": sans[i + 1],
+            "eval_cp": eval_cp[i],
+            "swing": swing
+        }
+        for swing, i in top
+    ]
+
+def _analyze(req: AnalyzeRequest, max_chunks: Optional[int] = None) -> Dict[str, Any]:
+    try:
+        walk = _walk_mainline(req, max_chunks)
+        key_sorted = _run_analysis(req, walk)
+        return ok(legal=True, per_ply=_rows(walk), key_moments=key_sorted)
+
+    except _AnalysisFailed as e:
+        return e.envelope
 
     except Exception as e:
         # Always return stable envelope, never crash ASGI
         return fail("INTERNAL_ERROR", "Unexpected internal error during analysis.", details={"exception": str(e)})
 
+def _result_key(req: AnalyzeRequest) -> str:
+    # Every request field affects the response, so hash all of them
+    payload = orjson.dumps(req.model_dump(), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def _result_cache_get(key: str) -> Optional[Tuple[bytes, str]]:
+    with _result_cache_lock:
+        hit = _result_cache.get(key)
+        if hit is None:
+            return None
+        expires, body, etag = hit
+        if expires < time.monotonic():
+            del _result_cache[key]
+            return None
+        _result_cache.move_to_end(key)
+        return body, etag
+
+def _result_cache_put(key: str, body: bytes, etag: str) -> None:
+    if RESULT_CACHE_SIZE <= 0:
+        return
+    with _result_cache_lock:
+        _result_cache[key] = (time.monotonic() + RESULT_CACHE_TTL_SEC, body, etag)
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+def _body_etag(body: bytes) -> str:
+    # Derived from the bytes sent: analysis is time-limited and not
+    # deterministic, so a recomputed response must not reuse an old tag.
+    return '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses weak comparison: W/ prefixes are ignored and the
+    # header may list several tags. Only explicit tags match; "*" is not a
+    # validator for a POST that may not have been served before.
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        if tag.strip().removeprefix("W/") == etag:
+            return True
+    return False
+
+def _analysis_body(req: AnalyzeRequest, key: str, max_chunks: Optional[int] = None) -> Tuple[bytes, Optional[str]]:
+    # Returns the serialized response and its ETag. The ETag is None when the
+    # response is not cacheable (status other than ok).
+    hit = _result_cache_get(key)
+    if hit is not None:
+        return hit
+
+    envelope = _analyze(req, max_chunks)
+    # Validate and serialize in one pass in pydantic-core
+    body = AnalyzeResponse.model_validate(envelope).model_dump_json().encode()
+    if envelope["status"] != "ok":
+        return body, None
+
+    etag = _body_etag(body)
+    _result_cache_put(key, body, etag)
+    return body, etag
+
+@app.post("/analyze_pgn", response_model=AnalyzeResponse)
+def analyze_pgn(req: AnalyzeRequest, if_none_match: Optional[str] = Header(None)) -> Response:
+    # Successful responses are cached whole, keyed by a hash of the request
+    # body. The ETag is a hash of the response body itself, so a client
+    # holding exactly these bytes gets a 304.
+    body, etag = _analysis_body(req, _result_key(req))
+
+    if etag is None:
+        return Response(body, media_type="application/json")
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+@app.post("/analyze_pgns", response_model=List[AnalyzeResponse])
+def analyze_pgns(batch: BatchRequest) -> Response:
+    games = batch.games
+    if not games:
+        return Response(b"[]", media_type="application/json")
+
+    # Split the pool between games: once there are at least as many games as
+    # engines, each game is a single chunk (one engine, warm hash throughout)
+    # and the parallelism comes from running games side by side.
+    max_chunks = max(1, ENGINE_POOL_SIZE // len(games))
+
+    # Per-game coordinators run outside EXECUTOR (they wait on chunk futures
+    # queued there) and all feed the same engine pool.
+    with ThreadPoolExecutor(max_workers=min(len(games), 2 * max(1, ENGINE_POOL_SIZE))) as coordinators:
+        bodies = list(coordinators.map(
+            lambda g: _analysis_body(g, _result_key(g), max_chunks)[0],
+            games,
+        ))
+
+    return Response(b"[" + b",".join(bodies) + b"]", media_type="application/json")
+
+def _stream_lines(req: AnalyzeRequest) -> Iterator[bytes]:
+    lines: "queue.Queue[Optional[bytes]]" = queue.Queue()
+    cancel = threading.Event()
+
+    def on_ply(row: Dict[str, Any]) -> None:
+        lines.put(orjson.dumps({"type": "ply", **row}, option=orjson.OPT_APPEND_NEWLINE))
+
+    def work() -> None:
+        try:
+            walk = _walk_mainline(req)
+            envelope = ok(legal=True, key_moments=_run_analysis(req, walk, on_ply, cancel))
+        except _AnalysisFailed as e:
+            envelope = e.envelope
+        except Exception as e:
+            envelope = fail("INTERNAL_ERROR", "Unexpected internal error during analysis.", details={"exception": str(e)})
+        # per_ply has already gone out line by line
+        envelope.pop("per_ply", None)
+        lines.put(orjson.dumps({"type": "summary", **envelope}, option=orjson.OPT_APPEND_NEWLINE))
+        lines.put(None)
+
+    # Runs outside EXECUTOR: it waits on chunk futures queued there.
+    threading.Thread(target=work, daemon=True).start()
+    try:
+        while True:
+            line = lines.get()
+            if line is None:
+                return
+            yield line
     finally:
-        if engine is not None:
-            try:
-                engine.quit()
-            except Exception:
-                pass
+        # Client went away (or we finished): stop handing plies to engines
+        cancel.set()
+
+@app.post("/analyze_pgn_stream")
+def analyze_pgn_stream(req: AnalyzeRequest) -> StreamingResponse:
+    # NDJSON: one {"type": "ply", ...} line per ply as soon as its analysis is
+    # ready (not necessarily in ply order; in two-pass mode a later line for a
+    # ply supersedes the earlier one), then a final {"type": "summary", ...}
+    # line with status, key_moments and error. Disconnecting cancels the
+    # remaining engine work.
+    return StreamingResponse(_stream_lines(req), media_type="application/x-ndjson")